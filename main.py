@@ -1,13 +1,38 @@
+import logging
 import os
-import time
-import json
-import requests
+import re
+import sys
+from functools import lru_cache
+import orjson
+import httpx
+import redis.asyncio as redis
+from cachetools import TTLCache
 from typing import Optional
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import PlainTextResponse
-from sqlalchemy import create_engine, String, Integer, Float, Boolean, ForeignKey, select
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker, relationship
+try:
+    import uvloop  # faster event loop when launched outside `uvicorn --loop uvloop`
+    uvloop.install()
+except ImportError:
+    pass
+
+try:
+    from numba import njit, prange  # optional: JIT the price-impact math
+except ImportError:
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+    prange = range
+
+from fastapi import BackgroundTasks, FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from sqlalchemy import String, Integer, Float, Boolean, ForeignKey, Index, event, func, select, text, true
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+
+logger = logging.getLogger(__name__)
 
 # =========================
 # ENV VARS (set in Render)
@@ -17,18 +42,68 @@ WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN", "")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID", "")
 
 # SQLite file (Render note: filesystem may reset on redeploy/free tier)
-DB_URL = os.getenv("DATABASE_URL", "sqlite:///./mvp.db")
+DB_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./mvp.db")
+
+# The engine is async, so sync-driver URLs (as previously accepted, or as handed out
+# by Render/Heroku for Postgres) are rewritten to their asyncio driver.
+ASYNC_DRIVER_SCHEMES = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+def to_async_db_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        raise RuntimeError(f"Invalid DATABASE_URL: {url!r}")
+    return f"{ASYNC_DRIVER_SCHEMES.get(scheme, scheme)}://{rest}"
+
+DB_URL = to_async_db_url(DB_URL)
+
+# Optional Redis for short-lived read caches (markets list / market detail)
+REDIS_URL = os.getenv("REDIS_URL", "")
 
 GRAPH_URL = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
 
 # =========================
 # DB
 # =========================
-engine = create_engine(
+# Async engine so DB waits inside the webhook don't block the event loop
+IS_SQLITE = DB_URL.startswith("sqlite")
+engine = create_async_engine(
     DB_URL,
-    connect_args={"check_same_thread": False} if DB_URL.startswith("sqlite") else {},
+    # isolation_level=None: driver stays out of the way, we emit BEGIN ourselves (see below)
+    connect_args={"check_same_thread": False, "isolation_level": None} if IS_SQLITE else {},
+)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",  # no fsync per commit in WAL mode
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA cache_size=-65536",  # 64 MB
 )
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+if IS_SQLITE:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def _sqlite_on_begin(conn):
+        # Write paths ask for BEGIN IMMEDIATE so they take the writer lock up front
+        # instead of failing on a read->write lock upgrade under concurrency.
+        if conn.get_execution_options().get("sqlite_begin_immediate"):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            conn.exec_driver_sql("BEGIN")
+
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
 class Base(DeclarativeBase):
     pass
@@ -40,154 +115,442 @@ class User(Base):
 
 class Market(Base):
     __tablename__ = "markets"
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)  # rowid alias
     question: Mapped[str] = mapped_column(String)
     is_open: Mapped[bool] = mapped_column(Boolean, default=True)
     yes_price: Mapped[float] = mapped_column(Float, default=0.50)
     no_price: Mapped[float] = mapped_column(Float, default=0.50)
 
-    bets = relationship("Bet", back_populates="market")
+    # lazy="raise": any accidental per-row lazy load (N+1) fails loudly
+    bets = relationship("Bet", back_populates="market", lazy="raise")
+
+# Unix-epoch seconds from the DB clock (see migrate_bets_ts_default for older SQLite files)
+BET_TS_DEFAULT = (
+    func.strftime("%s", "now") if IS_SQLITE
+    else text("CAST(EXTRACT(EPOCH FROM now()) AS INTEGER)")
+)
 
 class Bet(Base):
     __tablename__ = "bets"
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)  # rowid alias
     wa_id: Mapped[str] = mapped_column(ForeignKey("users.wa_id"))
     market_id: Mapped[int] = mapped_column(ForeignKey("markets.id"))
     side: Mapped[str] = mapped_column(String)  # YES/NO
     price: Mapped[float] = mapped_column(Float)
     qty: Mapped[int] = mapped_column(Integer)
-    ts: Mapped[int] = mapped_column(Integer, default=lambda: int(time.time()))
+    ts: Mapped[int] = mapped_column(Integer, server_default=BET_TS_DEFAULT)  # set by the DB on INSERT
+
+    market = relationship("Market", back_populates="bets", lazy="raise")
+
+    __table_args__ = (
+        Index("ix_bets_wa_market", "wa_id", "market_id"),  # also serves wa_id-only lookups
+        Index("ix_bets_market", "market_id"),
+    )
+
+# =========================
+# Caches
+# =========================
+# Process-local, checked before the DB. A bet can only invalidate its own process, so
+# this layer is used only for a single worker without Redis; otherwise Redis is the cache.
+USE_LOCAL_CACHE = not REDIS_URL and int(os.getenv("WEB_CONCURRENCY", "1")) <= 1
+_user_cache = TTLCache(maxsize=10000, ttl=30)  # wa_id -> balance
+_market_cache = TTLCache(maxsize=1000, ttl=5)  # market_id -> market fields
+# Bumped on every bet; a read only fills the cache if no bet committed while it was in
+# flight, so an invalidation can't be overwritten by the value read just before it.
+_local_cache_epoch = 0
+
+def local_cache_get(cache: TTLCache, key):
+    return cache.get(key) if USE_LOCAL_CACHE else None
+
+async def local_cache_read_epoch(db) -> int:
+    # Call before the DB read whose result will be cached. Any open read transaction is
+    # ended first: under WAL it would keep a snapshot from before a bet that already
+    # bumped the epoch, and the stale row would then pass the epoch check.
+    if db.in_transaction():
+        await db.commit()
+    return _local_cache_epoch
+
+def local_cache_fill(cache: TTLCache, key, value, epoch: int):
+    if USE_LOCAL_CACHE and epoch == _local_cache_epoch:
+        cache[key] = value
+
+def local_cache_invalidate(wa_id: str, market_id: int):
+    global _local_cache_epoch
+    _local_cache_epoch += 1
+    _user_cache.pop(wa_id, None)
+    _market_cache.pop(market_id, None)
+
+# Redis (optional), shared across workers
+rcache = redis.from_url(REDIS_URL) if REDIS_URL else None
+CACHE_TTL = 5  # seconds
+MARKETS_TEXT_KEY = "markets:text"
+
+def market_key(market_id: int) -> str:
+    return f"market:{market_id}"
+
+async def cache_get(key: str) -> Optional[bytes]:
+    if rcache is None:
+        return None
+    try:
+        return await rcache.get(key)
+    except redis.RedisError:
+        return None  # cache is best-effort, fall back to DB
 
-    market = relationship("Market", back_populates="bets")
+async def cache_set(key: str, value, ttl: int = CACHE_TTL):
+    if rcache is None:
+        return
+    try:
+        await rcache.set(key, value, ex=ttl)
+    except redis.RedisError:
+        pass
 
-Base.metadata.create_all(bind=engine)
+async def cache_delete(*keys: str):
+    if rcache is None:
+        return
+    try:
+        await rcache.delete(*keys)
+    except redis.RedisError:
+        pass
 
 # =========================
 # WhatsApp send helpers
 # =========================
-def send_whatsapp(payload: dict):
+TO_PLACEHOLDER = b"__TO__"
+
+# One pooled HTTP/2 client so sends to graph.facebook.com reuse the TLS connection
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=20.0,
+    headers={"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"},
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+
+async def send_whatsapp_raw(payload: bytes):
     if not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
         raise RuntimeError("Missing WHATSAPP_TOKEN or PHONE_NUMBER_ID env vars")
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-    r = requests.post(GRAPH_URL, headers=headers, data=json.dumps(payload), timeout=20)
+    r = await _http.post(GRAPH_URL, content=payload)
     if r.status_code >= 300:
         raise RuntimeError(f"WhatsApp send failed {r.status_code}: {r.text}")
     return r.json()
 
-def send_text(to_wa_id: str, text: str):
+async def send_whatsapp(payload: dict):
+    return await send_whatsapp_raw(orjson.dumps(payload))
+
+async def send_static(to_wa_id: str, payload: bytes):
+    # payload is a pre-serialized template; only the recipient is patched in, JSON-escaped
+    # (orjson.dumps gives the quoted string literal, the slice drops the quotes)
+    return await send_whatsapp_raw(payload.replace(TO_PLACEHOLDER, orjson.dumps(to_wa_id)[1:-1], 1))
+
+def _text_payload_template(text: str) -> bytes:
+    return orjson.dumps({
+        "messaging_product": "whatsapp",
+        "to": TO_PLACEHOLDER.decode(),
+        "type": "text",
+        "text": {"body": text},
+    })
+
+WELCOME_TEXT = "Welcome! Type 'markets' to see questions, or 'balance'."
+HELP_TEXT = "Send: markets | balance | <market_id> (example: 1)"
+MARKET_NOT_FOUND_TEXT = "Market not found. Type 'markets'."
+BET_MARKET_NOT_FOUND_TEXT = "Market not found. Send 'markets'."
+MARKET_CLOSED_TEXT = "Market is closed."
+INVALID_SIDE_TEXT = "Invalid side."
+
+# Fixed replies serialized once at import, keyed by their text
+STATIC_PAYLOADS = {
+    text: _text_payload_template(text)
+    for text in (
+        WELCOME_TEXT,
+        HELP_TEXT,
+        MARKET_NOT_FOUND_TEXT,
+        BET_MARKET_NOT_FOUND_TEXT,
+        MARKET_CLOSED_TEXT,
+        INVALID_SIDE_TEXT,
+    )
+}
+
+async def send_text(to_wa_id: str, text: str):
+    static = STATIC_PAYLOADS.get(text)
+    if static is not None:
+        return await send_static(to_wa_id, static)
     payload = {
         "messaging_product": "whatsapp",
         "to": to_wa_id,
         "type": "text",
         "text": {"body": text},
     }
-    return send_whatsapp(payload)
-
-def send_yes_no_buttons(to_wa_id: str, market: Market):
-    # Reply buttons (up to 3) are supported by WhatsApp Cloud API. :contentReference[oaicite:2]{index=2}
-    body = f"{market.question}\n\nYES: {market.yes_price:.2f} | NO: {market.no_price:.2f}\n\nChoose:"
+    return await send_whatsapp(payload)
+
+@lru_cache(maxsize=512)
+def _button_payload_template(market_id: int, question: str, yes_price: float, no_price: float) -> bytes:
+    # Pre-serialized payload with a "to" placeholder; prices are rounded by the caller
+    # so every user tapping the same market at the same price shares one entry.
+    yes = f"{yes_price:.2f}"
+    no = f"{no_price:.2f}"
+    body = f"{question}\n\nYES: {yes} | NO: {no}\n\nChoose:"
     payload = {
         "messaging_product": "whatsapp",
-        "to": to_wa_id,
+        "to": TO_PLACEHOLDER.decode(),
         "type": "interactive",
         "interactive": {
             "type": "button",
             "body": {"text": body},
             "action": {
                 "buttons": [
-                    {"type": "reply", "reply": {"id": f"BET|{market.id}|YES", "title": f"YES ({market.yes_price:.2f})"}},
-                    {"type": "reply", "reply": {"id": f"BET|{market.id}|NO",  "title": f"NO ({market.no_price:.2f})"}},
+                    {"type": "reply", "reply": {"id": f"BET|{market_id}|YES", "title": f"YES ({yes})"}},
+                    {"type": "reply", "reply": {"id": f"BET|{market_id}|NO",  "title": f"NO ({no})"}},
                 ]
             },
         },
     }
-    return send_whatsapp(payload)
+    return orjson.dumps(payload)
+
+async def send_yes_no_buttons(to_wa_id: str, market: Market):
+    # Reply buttons (up to 3) are supported by WhatsApp Cloud API. :contentReference[oaicite:2]{index=2}
+    template = _button_payload_template(
+        market.id, market.question, round(market.yes_price, 2), round(market.no_price, 2)
+    )
+    return await send_static(to_wa_id, template)
+
+async def deliver(send, to_wa_id: str, *args):
+    # Wrapper for sends queued as background tasks: they run after the response, outside
+    # the webhook's try/except, so failures are logged here instead of escaping the app.
+    try:
+        await send(to_wa_id, *args)
+    except Exception:
+        logger.exception("WhatsApp %s to %s failed", send.__name__, to_wa_id)
 
 # =========================
 # Market mechanics (toy)
 # =========================
-def apply_price_impact(m: Market, side: str, qty: int):
+# Interned so side checks against parsed button ids hit the identity fast path
+SIDE_YES = sys.intern("YES")
+SIDE_NO = sys.intern("NO")
+SIDES = (SIDE_YES, SIDE_NO)
+
+# Button reply ids we generate: BET|<market_id>|YES or BET|<market_id>|NO
+BUTTON_ID_RE = re.compile(r"BET\|(\d+)\|(YES|NO)")
+
+BET_PLACED_TEMPLATE = "✅ Bet placed!\nMarket %d: %s\nYou: BUY %s @ %.2f × %d\nBalance: %.2f"
+
+@njit(cache=True)
+def _impact(yes_price, no_price, side_is_yes, qty):
     impact = min(0.10, 0.001 * qty)
-    if side == "YES":
-        m.yes_price = min(0.99, m.yes_price + impact)
-        m.no_price = max(0.01, 1.0 - m.yes_price)
+    if side_is_yes:
+        yes_price = min(0.99, yes_price + impact)
+        no_price = max(0.01, 1.0 - yes_price)
     else:
-        m.no_price = min(0.99, m.no_price + impact)
-        m.yes_price = max(0.01, 1.0 - m.no_price)
+        no_price = min(0.99, no_price + impact)
+        yes_price = max(0.01, 1.0 - no_price)
+    return yes_price, no_price
+
+@njit(cache=True, parallel=True)
+def _impact_batch(yes_prices, no_prices, sides_yes, qtys):
+    # One bet per market, applied in place (bulk replay / backtests).
+    # Markets are independent, so this parallelises when numba is installed.
+    for i in prange(len(qtys)):
+        yes_prices[i], no_prices[i] = _impact(yes_prices[i], no_prices[i], sides_yes[i], qtys[i])
+
+def apply_price_impact(m: Market, side: str, qty: int):
+    m.yes_price, m.no_price = _impact(m.yes_price, m.no_price, side == SIDE_YES, qty)
 
 # =========================
 # FastAPI app
 # =========================
-app = FastAPI(title="WhatsApp Prediction MVP (Play Money)")
-
-def ensure_seed_markets():
-    with SessionLocal() as db:
-        count = db.scalar(select(Market).count())  # SQLAlchemy 2: doesn't support .count() like this in all DBs
-        # safer:
-        count = db.scalar(select(Market.id).limit(1))
-        if count is not None:
+app = FastAPI(title="WhatsApp Prediction MVP (Play Money)", default_response_class=ORJSONResponse)
+
+async def ensure_seed_markets():
+    async with SessionLocal() as db:
+        # Probe and seed under the writer lock so concurrent workers starting on a fresh DB
+        # serialize here: the first one seeds, the rest see the markets and skip.
+        await begin_write(db)
+        has_markets = await db.scalar(select(select(Market.id).exists()))
+        if not has_markets:
+            db.add_all([
+                Market(question="Will India win the next match?", yes_price=0.50, no_price=0.50),
+                Market(question="Will it rain in Mumbai tomorrow?", yes_price=0.45, no_price=0.55),
+            ])
+            await db.commit()
+
+def migrate_bets_ts_default(conn):
+    # Tables created before bets.ts had a server default keep "ts INTEGER NOT NULL" with no
+    # default (create_all never alters), so every bet INSERT would fail. SQLite can't ALTER a
+    # column default, so rebuild the table; Postgres can set it in place.
+    if IS_SQLITE:
+        cols = conn.exec_driver_sql("PRAGMA table_info(bets)").fetchall()
+        ts_col = next((c for c in cols if c[1] == "ts"), None)  # (cid, name, type, notnull, dflt_value, pk)
+        if ts_col is None or ts_col[4] is not None:
             return
-        db.add_all([
-            Market(question="Will India win the next match?", yes_price=0.50, no_price=0.50),
-            Market(question="Will it rain in Mumbai tomorrow?", yes_price=0.45, no_price=0.55),
-        ])
-        db.commit()
-
-ensure_seed_markets()
-
-def list_markets_text(db) -> str:
-    markets = db.scalars(select(Market).order_by(Market.id.asc())).all()
+        conn.exec_driver_sql("ALTER TABLE bets RENAME TO bets_old")
+        for index in Bet.__table__.indexes:  # names still taken by bets_old's indexes
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+        Bet.__table__.create(conn)
+        conn.exec_driver_sql(
+            "INSERT INTO bets (id, wa_id, market_id, side, price, qty, ts) "
+            "SELECT id, wa_id, market_id, side, price, qty, ts FROM bets_old"
+        )
+        conn.exec_driver_sql("DROP TABLE bets_old")
+    else:
+        conn.execute(text(
+            "ALTER TABLE bets ALTER COLUMN ts SET DEFAULT CAST(EXTRACT(EPOCH FROM now()) AS INTEGER)"
+        ))
+
+@app.on_event("startup")
+async def on_startup():
+    # BEGIN IMMEDIATE: schema checks read first, and a deferred transaction's read->write
+    # upgrade fails outright when another worker is doing the same on a fresh DB.
+    async with engine.execution_options(sqlite_begin_immediate=True).begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate_bets_ts_default)
+    await ensure_seed_markets()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await _http.aclose()
+
+MARKET_COLUMNS = (Market.id, Market.question, Market.is_open, Market.yes_price, Market.no_price)
+
+async def list_markets_text(db) -> str:
+    cached = await cache_get(MARKETS_TEXT_KEY)
+    if cached is not None:
+        return cached.decode()
+    # Read-only: plain Core rows, no Market instances. When bet stats are shown here,
+    # add them to this same query (outerjoin Bet + group_by Market.id), never per row.
+    rows = await db.execute(select(*MARKET_COLUMNS).order_by(Market.id.asc()))
     lines = ["Available markets (send the market number):"]
-    for m in markets:
-        status = "OPEN" if m.is_open else "CLOSED"
-        lines.append(f"{m.id}) {m.question}  [YES {m.yes_price:.2f} / NO {m.no_price:.2f}] ({status})")
+    for market_id, question, is_open, yes_price, no_price in rows:
+        status = "OPEN" if is_open else "CLOSED"
+        lines.append(f"{market_id}) {question}  [YES {yes_price:.2f} / NO {no_price:.2f}] ({status})")
     lines.append("\nCommands: markets | balance | <market_id>")
-    return "\n".join(lines)
+    s = "\n".join(lines)
+    # Unguarded: a bet committing during this read can be overwritten; bounded by CACHE_TTL
+    await cache_set(MARKETS_TEXT_KEY, s)
+    return s
+
+async def get_market(db, market_id: int) -> Optional[Market]:
+    # Read-only lookup; returns a detached Market built from cached/selected fields
+    fields = local_cache_get(_market_cache, market_id)
+    if fields is None:
+        epoch = await local_cache_read_epoch(db)
+        cached = await cache_get(market_key(market_id))
+        if cached is not None:
+            fields = orjson.loads(cached)
+        else:
+            row = (await db.execute(select(*MARKET_COLUMNS).where(Market.id == market_id))).mappings().first()
+            if row is None:
+                return None
+            fields = dict(row)
+            # Unguarded: a bet committing during this read can be overwritten; bounded by CACHE_TTL
+            await cache_set(market_key(market_id), orjson.dumps(fields))
+        local_cache_fill(_market_cache, market_id, fields, epoch)
+    return Market(**fields)
+
+async def begin_write(db):
+    # End any open read transaction so the next one starts as a write transaction
+    if db.in_transaction():
+        await db.commit()
+    await db.connection(execution_options={"sqlite_begin_immediate": True})
+
+def upsert_user_stmt(wa_id: str):
+    # INSERT ... ON CONFLICT DO NOTHING: safe when two handlers create the same user
+    insert = sqlite_insert if IS_SQLITE else pg_insert
+    return (
+        insert(User)
+        .values(wa_id=wa_id, balance=1000.0)
+        .on_conflict_do_nothing(index_elements=[User.wa_id])
+    )
 
-def get_or_create_user(db, wa_id: str) -> User:
-    u = db.get(User, wa_id)
+async def get_or_create_user(db, wa_id: str) -> User:
+    # On a cache hit the User is detached (read-only); writes go through place_bet
+    balance = local_cache_get(_user_cache, wa_id)
+    if balance is not None:
+        return User(wa_id=wa_id, balance=balance)
+    epoch = await local_cache_read_epoch(db)
+    u = await db.get(User, wa_id)
     if not u:
-        u = User(wa_id=wa_id, balance=1000.0)
-        db.add(u)
-        db.commit()
-        db.refresh(u)
+        await begin_write(db)
+        await db.execute(upsert_user_stmt(wa_id))
+        await db.commit()
+        u = await db.get(User, wa_id)
+    local_cache_fill(_user_cache, wa_id, u.balance, epoch)
     return u
 
-def place_bet(db, wa_id: str, market_id: int, side: str, qty: int = 10):
-    u = get_or_create_user(db, wa_id)
-    m = db.get(Market, market_id)
-    if not m:
-        send_text(wa_id, "Market not found. Send 'markets'.")
-        return
+async def _reply_without_bet(db, reply: str) -> str:
+    # No bet placed, but still commit the user upsert so first-time users are saved
+    await db.commit()
+    return reply
+
+async def place_bet(db, wa_id: str, market_id: int, side: str, qty: int = 10) -> str:
+    # Returns the reply text; the caller queues the send so the webhook can ACK first
+    await begin_write(db)
+    # Upsert the user (no-op if it exists) and load user + market in one SELECT,
+    # then commit once after the bet so it's a single transaction per bet.
+    await db.execute(upsert_user_stmt(wa_id))
+    row = (await db.execute(
+        select(User, Market)
+        .join(Market, true())
+        .where(User.wa_id == wa_id, Market.id == market_id)
+        # Row-lock user and market until commit (Postgres); SQLite is serialized by
+        # BEGIN IMMEDIATE instead and compiles this to nothing.
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )).first()
+    if row is None:
+        return await _reply_without_bet(db, BET_MARKET_NOT_FOUND_TEXT)
+    u, m = row
     if not m.is_open:
-        send_text(wa_id, "Market is closed.")
-        return
+        return await _reply_without_bet(db, MARKET_CLOSED_TEXT)
 
-    side = side.upper()
-    if side not in ("YES", "NO"):
-        send_text(wa_id, "Invalid side.")
-        return
+    if side not in SIDES:
+        return await _reply_without_bet(db, INVALID_SIDE_TEXT)
 
-    price = m.yes_price if side == "YES" else m.no_price
+    price = m.yes_price if side == SIDE_YES else m.no_price
     cost = qty * price
     if u.balance < cost:
-        send_text(wa_id, f"Insufficient balance. Need {cost:.2f}, you have {u.balance:.2f}")
-        return
+        return await _reply_without_bet(db, f"Insufficient balance. Need {cost:.2f}, you have {u.balance:.2f}")
 
     u.balance -= cost
     b = Bet(wa_id=wa_id, market_id=m.id, side=side, price=price, qty=qty)
     db.add(b)
     apply_price_impact(m, side, qty)
-    db.commit()
+    await db.commit()
+    local_cache_invalidate(wa_id, m.id)
+    await cache_delete(MARKETS_TEXT_KEY, market_key(m.id))
 
-    send_text(
-        wa_id,
-        f"✅ Bet placed!\nMarket {m.id}: {m.question}\nYou: BUY {side} @ {price:.2f} × {qty}\nBalance: {u.balance:.2f}"
-    )
+    return BET_PLACED_TEMPLATE % (m.id, m.question, side, price, qty, u.balance)
+
+# -------- Text commands --------
+async def _welcome(db, u: User, bg: BackgroundTasks):
+    bg.add_task(deliver, send_static, u.wa_id, STATIC_PAYLOADS[WELCOME_TEXT])
+
+async def _markets(db, u: User, bg: BackgroundTasks):
+    bg.add_task(deliver, send_text, u.wa_id, await list_markets_text(db))
+
+async def _balance(db, u: User, bg: BackgroundTasks):
+    bg.add_task(deliver, send_text, u.wa_id, f"Your balance: {u.balance:.2f}")
+
+async def _market_detail(db, u: User, bg: BackgroundTasks, market_id: int):
+    m = await get_market(db, market_id)
+    if not m:
+        bg.add_task(deliver, send_static, u.wa_id, STATIC_PAYLOADS[MARKET_NOT_FOUND_TEXT])
+    else:
+        bg.add_task(deliver, send_yes_no_buttons, u.wa_id, m)
+
+def _help(u: User, bg: BackgroundTasks):
+    bg.add_task(deliver, send_static, u.wa_id, STATIC_PAYLOADS[HELP_TEXT])
+
+# One dict lookup per message; numeric market ids are handled separately
+_HANDLERS = {
+    "hi": _welcome,
+    "hello": _welcome,
+    "start": _welcome,
+    "markets": _markets,
+    "balance": _balance,
+}
 
 # -------- Webhook verify (GET) --------
 @app.get("/webhook", response_class=PlainTextResponse)
-def verify_webhook(request: Request):
+async def verify_webhook(request: Request):
     # Meta webhook verification expects hub.challenge echo if verify token matches. :contentReference[oaicite:3]{index=3}
     qp = request.query_params
     mode = qp.get("hub.mode")
@@ -198,9 +561,16 @@ def verify_webhook(request: Request):
     raise HTTPException(status_code=403, detail="Webhook verification failed")
 
 # -------- Incoming messages (POST) --------
+# Outbound sends are queued as background tasks so Meta gets the 200 right away
+# instead of waiting on Graph API round-trips (Meta retries slow webhooks).
 @app.post("/webhook")
-async def inbound(request: Request):
-    data = await request.json()
+async def inbound(request: Request, bg: BackgroundTasks):
+    body = await request.body()
+    # Status callbacks (sent/delivered/read) carry no "messages" key and are ignored
+    # anyway, so skip JSON parsing for them entirely.
+    if b'"messages"' not in body:
+        return {"ok": True}
+    data = orjson.loads(body)
 
     try:
         entry = (data.get("entry") or [])[0]
@@ -215,41 +585,34 @@ async def inbound(request: Request):
         if not wa_id:
             return {"ok": True}
 
-        with SessionLocal() as db:
-            get_or_create_user(db, wa_id)
-
-            # 1) Button tap
+        async with SessionLocal() as db:
+            # 1) Button tap (place_bet upserts the user itself)
             if msg.get("type") == "interactive":
                 inter = msg.get("interactive") or {}
                 if inter.get("type") == "button_reply":
                     btn_id = inter["button_reply"]["id"]  # BET|<market_id>|YES
-                    parts = btn_id.split("|")
-                    if len(parts) == 3 and parts[0] == "BET":
-                        market_id = int(parts[1])
-                        side = parts[2]
-                        place_bet(db, wa_id, market_id, side, qty=10)
+                    match = BUTTON_ID_RE.fullmatch(btn_id)
+                    if match:
+                        market_id = int(match.group(1))
+                        side = sys.intern(match.group(2))
+                        reply = await place_bet(db, wa_id, market_id, side, qty=10)
+                        bg.add_task(deliver, send_text, wa_id, reply)
                         return {"ok": True}
 
+            u = await get_or_create_user(db, wa_id)
+
             # 2) Text message
             text = ""
             if msg.get("type") == "text":
                 text = (msg["text"]["body"] or "").strip().lower()
 
-            if text in ("hi", "hello", "start"):
-                send_text(wa_id, "Welcome! Type 'markets' to see questions, or 'balance'.")
-            elif text == "markets":
-                send_text(wa_id, list_markets_text(db))
-            elif text == "balance":
-                u = db.get(User, wa_id)
-                send_text(wa_id, f"Your balance: {u.balance:.2f}")
-            elif text.isdigit():
-                m = db.get(Market, int(text))
-                if not m:
-                    send_text(wa_id, "Market not found. Type 'markets'.")
-                else:
-                    send_yes_no_buttons(wa_id, m)
+            handler = _HANDLERS.get(text)
+            if handler:
+                await handler(db, u, bg)
+            elif text and text[0].isdigit() and text.isdigit():
+                await _market_detail(db, u, bg, int(text))
             else:
-                send_text(wa_id, "Send: markets | balance | <market_id> (example: 1)")
+                _help(u, bg)
 
         return {"ok": True}
     except Exception as e:
@@ -258,5 +621,5 @@ async def inbound(request: Request):
 
 # Health check
 @app.get("/")
-def root():
+async def root():
     return {"ok": True, "service": "whatsapp-prediction-mvp"}
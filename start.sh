@@ -1,2 +1,6 @@
 #!/usr/bin/env bash
-uvicorn main:app --host 0.0.0.0 --port ${PORT:-8000}
+# uvloop + httptools come with uvicorn[standard]. Keep a single worker while the DB is
+# SQLite (async handles concurrency); raise WEB_CONCURRENCY only with a server DB.
+uvicorn main:app --host 0.0.0.0 --port ${PORT:-8000} \
+  --loop uvloop --http httptools \
+  --workers ${WEB_CONCURRENCY:-1} --backlog 2048